@@ -27,28 +27,48 @@ from __future__ import division
 from __future__ import print_function
 
 import argparse
-import json
+import errno
+import fcntl
 import os
+import re
+import select
+import signal
 import socket
 import subprocess
 import sys
 import tarfile
 import time
-import urllib
 from absl import flags
 from absl import logging
-
-VALID_URL_PREFIX = [
-    'https://www.googleapis.com/storage/v1/b/cloud-ingest-pub/o/',
-    'https://www.googleapis.com/storage/v1/b/cloud-ingest-canary/o/']
+import requests
+from requests import adapters
+from urllib3 import exceptions as urllib3_exceptions
+from urllib3.util import retry
+
+VALID_URL_REGEX = re.compile(
+    r'^https://www\.googleapis\.com/storage/v1/b/'
+    r'cloud-ingest-(?:pub|canary)/o/.+$')
 STABLE_AGENT_BINARY_ADDRESS = 'https://www.googleapis.com/storage/v1/b/cloud-ingest-pub/o/agent%2fcurrent%2fagent-linux_amd64.tar.gz'
-AGENT_BINARY_FILE_NAME = 'agent-linux_amd64.tar.gz'
 POSTFIX = '?alt=media'
 # A separate log directory is created under the directory of agent binary log
 # to store the logs from this script.
 LOG_FOLDER_NAME = '/autoupdate'
 CHECK_INTERVAL_SECONDS = 5 * 60
+# Read size used when streaming the agent archive; tarfile defaults to 10 KiB
+# records, which turns a multi-MB download into hundreds of small reads.
+EXTRACT_BUFFER_SIZE = 1 << 20
+# Delay before restarting an agent that exited during a check interval. It
+# doubles after each consecutive early exit, up to the check interval, so an
+# agent that keeps crashing is not re-downloaded every few seconds.
+MIN_CHECK_INTERVAL_SECONDS = 10
 MOUNT_DIR = '/transfer_root'
+# How long to wait for the agent to exit after SIGTERM before sending SIGKILL,
+# and how long to wait after SIGKILL before giving up on it.
+TERMINATE_TIMEOUT_SECONDS = 30
+KILL_TIMEOUT_SECONDS = 5
+
+# time.monotonic is not available on Python 2, where the wall clock is used.
+_monotonic = getattr(time, 'monotonic', time.time)
 
 FLAGS = flags.FLAGS
 # Flag used in integration tests to pass a test URL as stable agent binary URL.
@@ -59,24 +79,58 @@ flags.DEFINE_integer('check_interval_seconds', CHECK_INTERVAL_SECONDS,
 flags.DEFINE_boolean('enable_mount_directory', False,
                      'Enable adding mount directory')
 
+# All requests go to www.googleapis.com, so a single pooled session keeps the
+# HTTPS connection alive across check intervals instead of paying a new TCP and
+# TLS handshake on every poll.
+_SESSION = requests.Session()
+_SESSION.mount('https://', adapters.HTTPAdapter(
+    pool_connections=1, pool_maxsize=2,
+    max_retries=retry.Retry(total=3, backoff_factor=0.3)))
+
+# Maps a metadata URL to the (ETag, version) of its last successful response,
+# so unchanged metadata is answered with a 304 instead of the full JSON body.
+_release_version_cache = {}
+
+# Maps an agent pid to the (mtime, contents) of its agent source file, so an
+# unchanged file only costs a stat() per check.
+_agent_source_cache = {}
+
+# Resolved once by agent_log_dir, the log directory does not change while the
+# script is running.
+_log_dir = None
+
+
+def agent_log_dir():
+  """Returns the agent log directory, resolving it on the first call."""
+  global _log_dir
+  if _log_dir is None:
+    _log_dir = logging.find_log_dir()
+  return _log_dir
+
+
+def agent_source_filename(process):
+  """Returns the file in which the agent records its update source URL."""
+  return os.path.join(agent_log_dir(), 'agent_source_%d.txt' % process.pid)
+
 
 def delete_agent_source_file(process):
   if process is None:
     return
 
+  filename = agent_source_filename(process)
   try:
-    filename = logging.find_log_dir() + '/agent_source_%d.txt' % process.pid
-    if os.path.exists(filename):
-      os.remove(filename)
+    os.remove(filename)
   except OSError as err:
-    logging.error('Failed to delete file %s, error: %s', filename, str(err))
+    if err.errno != errno.ENOENT:
+      logging.error('Failed to delete file %s, error: %s', filename, str(err))
 
 
 def agent_release_version(url):
   """Retrieve agent release version.
 
   Retrieve metadata of the GCS object and the value of version in custom
-  metadata.
+  metadata. The request is conditional on the ETag of the previous response for
+  the same URL, so an unchanged object is not downloaded again.
 
   Args:
     url: URL of the GCS object.
@@ -88,14 +142,21 @@ def agent_release_version(url):
     KeyError: An error occurred if the 'AgentVersion' field does not exist in
               the object's metadata.
   """
-  version = ''
-  response = None
   try:
-    response = urllib.urlopen(url).read()
-    version = json.loads(response)['metadata']['AgentVersion']
+    cached = _release_version_cache.get(url)
+    headers = {'If-None-Match': cached[0]} if cached else {}
+    response = _SESSION.get(url, headers=headers, timeout=30)
+    if cached and response.status_code == requests.codes.not_modified:
+      version = cached[1]
+    else:
+      response.raise_for_status()
+      version = response.json()['metadata']['AgentVersion']
+      etag = response.headers.get('ETag')
+      if etag:
+        _release_version_cache[url] = (etag, version)
     logging.info('Agent source URL: %s, agent version: %s', url, version)
     return version
-  except IOError as err:
+  except requests.RequestException as err:
     logging.error('Error occurs when opening url %s, error: %s',
                   url, str(err))
   except (ValueError, KeyError) as err:
@@ -114,19 +175,42 @@ def is_process_alive(process):
     return False
 
 
-def extract_agent_binary():
-  try:
-    tar = tarfile.open(AGENT_BINARY_FILE_NAME)
-    tar.extractall()
-    tar.close()
-  except tarfile.TarError as err:
-    logging.error('Failed to extract agent binary file: %s', str(err))
+def wait_for_process_exit(process, timeout_seconds):
+  """Waits for the process to exit.
+
+  Args:
+    process: Agent process.
+    timeout_seconds: Maximum number of seconds to wait.
+
+  Returns:
+    True if the process exited within timeout_seconds, False otherwise.
+  """
+  deadline = _monotonic() + timeout_seconds
+  while process.poll() is None:
+    if _monotonic() >= deadline:
+      return False
+    time.sleep(0.1)
+  return True
+
+
+def stop_agent(process):
+  """Stops the agent, killing it if it does not exit after SIGTERM."""
+  process.terminate()
+  if wait_for_process_exit(process, TERMINATE_TIMEOUT_SECONDS):
+    return
+
+  logging.warning('Agent %d did not exit after SIGTERM, sending SIGKILL.',
+                  process.pid)
+  process.kill()
+  if not wait_for_process_exit(process, KILL_TIMEOUT_SECONDS):
+    logging.error('Agent %d did not exit after SIGKILL.', process.pid)
 
 
 def download_and_start_agent(process, url, args):
   """Downloads the agent binary and starts it locally.
 
-  Downloads the agent from the given URL and extracts the agent binary. Starts
+  Downloads the agent from the given URL and extracts the agent binary while
+  the archive is streamed, without writing the archive to disk first. Starts
   the agent locally using the arguments passed into the script.
 
   Args:
@@ -139,17 +223,25 @@ def download_and_start_agent(process, url, args):
   """
 
   try:
+    if process is not None:
+      # Forget the old agent's source file whether it is still running or has
+      # already exited; its pid is not used again.
+      _agent_source_cache.pop(process.pid, None)
     if is_process_alive(process):
       delete_agent_source_file(process)
-      process.terminate()
-      process.wait()
+      stop_agent(process)
 
     download_url = url + POSTFIX
-    urllib.urlretrieve(download_url, AGENT_BINARY_FILE_NAME)
+    with _SESSION.get(download_url, stream=True, timeout=60) as response:
+      response.raise_for_status()
+      # Let urllib3 undo any Content-Encoding. The archive may then arrive
+      # either gzipped or already decompressed, so let tarfile detect it.
+      response.raw.decode_content = True
+      with tarfile.open(fileobj=response.raw, mode='r|*',
+                        bufsize=EXTRACT_BUFFER_SIZE) as tar:
+        tar.extractall()
     logging.info('Agent is downloaded successfully')
 
-    extract_agent_binary()
-
     start_args = ['./agent'] + args
     process = subprocess.Popen(start_args)
     logging.info('PID: %d', process.pid)
@@ -160,20 +252,24 @@ def download_and_start_agent(process, url, args):
   except OSError as ex:
     logging.error('OSError occurs when download and start agent: %s',
                   str(ex))
+  except tarfile.TarError as err:
+    logging.error('Failed to extract agent binary file: %s', str(err))
+  except urllib3_exceptions.HTTPError as err:
+    # Reading response.raw directly surfaces urllib3 errors raised mid-stream,
+    # which requests would otherwise have wrapped in RequestException.
+    logging.error('Failed to download agent binary file: %s', str(err))
 
 
 def is_valid_url(url):
-  for prefix in VALID_URL_PREFIX:
-    if url.startswith(prefix):
-      return True
-  return False
+  return bool(url) and VALID_URL_REGEX.match(url) is not None
 
 
 def update_url(process):
   """Get the agent update source URL.
 
   If there is no agent running locally, return the stable agent URL. Otherwise,
-  read the agent source text file to get the update source URL.
+  read the agent source text file to get the update source URL. The file is only
+  re-read when its modification time changes.
 
   Args:
     process: Agent process or None if there is no currently running process.
@@ -184,16 +280,22 @@ def update_url(process):
   if process is None:
     return FLAGS.stable_agent_url
 
-  filename = logging.find_log_dir() + 'agent_source_%d.txt' % process.pid
+  filename = agent_source_filename(process)
   try:
-    f = open(filename, 'r')
-    url = f.read()
+    mtime = os.stat(filename).st_mtime
+    cached = _agent_source_cache.get(process.pid)
+    if cached and cached[0] == mtime:
+      url = cached[1]
+    else:
+      with open(filename, 'r') as f:
+        url = f.read()
+      _agent_source_cache[process.pid] = (mtime, url)
     if is_valid_url(url):
       return url
     else:
       logging.error('URL is not valid, using default stable URL.')
       return FLAGS.stable_agent_url
-  except IOError:
+  except (IOError, OSError):
     return FLAGS.stable_agent_url
 
 
@@ -246,6 +348,99 @@ def check_and_update_agent_if_needed(process, local_version, args):
     return process, local_version
 
 
+def install_child_exit_wakeup():
+  """Installs a SIGCHLD handler that wakes up wait_for_next_check.
+
+  Returns:
+    The (read_fd, write_fd) pair of the wakeup pipe. read_fd becomes readable
+    whenever a child process exits.
+  """
+  read_fd, write_fd = os.pipe()
+  for fd in (read_fd, write_fd):
+    fcntl.fcntl(fd, fcntl.F_SETFL,
+                fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+  def on_child_exit(signum, frame):
+    del signum, frame
+    try:
+      os.write(write_fd, b'\0')
+    except OSError:
+      # The pipe is full, so a wakeup is already pending.
+      pass
+
+  signal.signal(signal.SIGCHLD, on_child_exit)
+  # Set SA_RESTART so that blocking calls which the kernel restarts (read,
+  # write, waitpid) are not failed with EINTR. poll and select are never
+  # restarted: that is what wakes up wait_for_next_check, but it also means a
+  # socket with a timeout, as used by every request here, can fail with EINTR
+  # if the agent exits mid-request. Python 2 cannot block SIGCHLD around the
+  # requests, so this is accepted: the interrupted request is logged as an
+  # error, and the same check then sees the dead agent and falls back to the
+  # stable agent with a fresh request.
+  signal.siginterrupt(signal.SIGCHLD, False)
+  return read_fd, write_fd
+
+
+def wait_for_next_check(wakeup_fd, process, timeout_seconds, restart_delay):
+  """Waits until the next agent check is due.
+
+  Returns after timeout_seconds, or earlier if the agent exits, but never
+  earlier than restart_delay seconds after the wait started. The wait starts
+  right after each check, i.e. right after the agent was (re)started. Exits of
+  other children, such as the agent stopped during an update, do not shorten
+  the wait.
+
+  Args:
+    wakeup_fd: Read end of the pipe returned by install_child_exit_wakeup.
+    process: Agent process or None if there is no currently running process.
+    timeout_seconds: Maximum number of seconds to wait.
+    restart_delay: Minimum number of seconds to wait if the agent exits.
+
+  Returns:
+    True if the wait was shortened because the agent exited.
+  """
+  start = _monotonic()
+  deadline = start + timeout_seconds
+  agent_exited = False
+  while True:
+    remaining = deadline - _monotonic()
+    if remaining <= 0:
+      return agent_exited
+    try:
+      readable, _, _ = select.select([wakeup_fd], [], [], remaining)
+    except select.error as err:
+      if err.args[0] != errno.EINTR:
+        raise
+      continue
+    if readable:
+      try:
+        while os.read(wakeup_fd, 4096):
+          pass
+      except OSError as err:
+        if err.errno != errno.EAGAIN:
+          raise
+      if not agent_exited and not is_process_alive(process):
+        agent_exited = True
+        deadline = min(deadline, start + restart_delay)
+
+
+def next_restart_delay(restart_delay, agent_exited, check_interval_seconds):
+  """Returns the restart delay to use for the next check interval.
+
+  Args:
+    restart_delay: Restart delay used for the interval that just ended.
+    agent_exited: Whether the agent exited during that interval.
+    check_interval_seconds: Agent version check interval.
+
+  Returns:
+    Twice restart_delay, capped at check_interval_seconds, if the agent exited,
+    or MIN_CHECK_INTERVAL_SECONDS once it stayed up for a full interval.
+  """
+  if agent_exited:
+    return min(restart_delay * 2, check_interval_seconds)
+  return MIN_CHECK_INTERVAL_SECONDS
+
+
 def setup_logging():
   """Logging related setup.
 
@@ -258,7 +453,7 @@ def setup_logging():
   if FLAGS.log_dir:
     log_dir = FLAGS.log_dir + LOG_FOLDER_NAME
   else:
-    log_dir = logging.find_log_dir() + LOG_FOLDER_NAME
+    log_dir = agent_log_dir() + LOG_FOLDER_NAME
 
   if FLAGS.enable_mount_directory:
     log_dir = MOUNT_DIR + log_dir
@@ -292,7 +487,7 @@ def main():
     unknown.append('--enable-directory-prefix')
   # Remove all empty strings from the arguments list because subprocess.popen
   # stops reading arguments after empty string.
-  args = [arg for arg in unknown if bool(arg)]
+  args = [arg for arg in unknown if arg]
 
   if not is_valid_url(FLAGS.stable_agent_url):
     logging.error('Stable URL %s is not valid, exiting auto update script...',
@@ -305,11 +500,19 @@ def main():
   # values will be reset later.
   version = ''
   process = None
+  check_interval_seconds = FLAGS.check_interval_seconds
+  # Wake up as soon as the agent exits so it is restarted without waiting for
+  # the rest of the check interval.
+  wakeup_fd, _ = install_child_exit_wakeup()
+  restart_delay = MIN_CHECK_INTERVAL_SECONDS
 
   while True:
     process, version = check_and_update_agent_if_needed(
         process, version, args)
-    time.sleep(FLAGS.check_interval_seconds)
+    agent_exited = wait_for_next_check(
+        wakeup_fd, process, check_interval_seconds, restart_delay)
+    restart_delay = next_restart_delay(
+        restart_delay, agent_exited, check_interval_seconds)
 
 if __name__ == '__main__':
   main()
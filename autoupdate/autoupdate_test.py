@@ -17,11 +17,21 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import io
+import json
 import os
+import shutil
+import signal
+import subprocess
+import tarfile
+import tempfile
+import time
 import unittest
 from absl import flags
 import autoupdate
 import mock
+import requests
+from urllib3 import exceptions as urllib3_exceptions
 
 TEST_OBJECT_HAS_VERSION = 'TEST_OBJECT_HAS_VERSION'
 TEST_OBJECT_MISSING_VERSION = 'TEST_OBJECT_MISSING_VERSION'
@@ -45,15 +55,27 @@ class MockPopen(object):
 
 class MockResponse(object):
 
-  def __init__(self, status_code, str_data):
+  def __init__(self, status_code, str_data, raw=None, headers=None):
     self.status_code = status_code
     self.str_data = str_data
+    self.raw = raw
+    self.headers = headers or {}
 
-  def read(self):
-    return self.str_data
+  def __enter__(self):
+    return self
 
+  def __exit__(self, *args):
+    return False
 
-def mock_urllib_urlopen(*args, **keywargs):
+  def raise_for_status(self):
+    if self.status_code >= 400:
+      raise requests.HTTPError('%d error' % self.status_code)
+
+  def json(self):
+    return json.loads(self.str_data)
+
+
+def mock_session_get(*args, **keywargs):
   del keywargs
   if args[0] == TEST_OBJECT_HAS_VERSION:
     return MockResponse(
@@ -65,6 +87,30 @@ def mock_urllib_urlopen(*args, **keywargs):
   return MockResponse(404, None)
 
 
+def agent_tarball(contents, mode='w:gz'):
+  buf = io.BytesIO()
+  with tarfile.open(fileobj=buf, mode=mode) as tar:
+    info = tarfile.TarInfo('agent')
+    info.size = len(contents)
+    tar.addfile(info, io.BytesIO(contents))
+  buf.seek(0)
+  return buf
+
+
+class TruncatedStream(object):
+  """Raw response stream that fails after returning the first few bytes."""
+
+  def __init__(self, data, size):
+    self.data = data[:size]
+
+  def read(self, *args, **kwargs):
+    del args, kwargs
+    if self.data:
+      data, self.data = self.data, b''
+      return data
+    raise urllib3_exceptions.ProtocolError('Connection broken')
+
+
 def create_agent_update_source_file(pid, text):
   filename = '/tmp/agent_source_%d.txt' % pid
 
@@ -79,22 +125,40 @@ def delete_agent_update_source_file(pid):
 
 class AgentReleaseVersionTest(unittest.TestCase):
 
-  @mock.patch('urllib.urlopen', side_effect=mock_urllib_urlopen)
+  def setUp(self):
+    super(AgentReleaseVersionTest, self).setUp()
+    autoupdate._release_version_cache.clear()
+
+  @mock.patch.object(autoupdate._SESSION, 'get', side_effect=mock_session_get)
   def testAgentReleaseVersion_Successful(self, _):
     want = TEST_OBJECT_HAS_VERSION
     got = autoupdate.agent_release_version(TEST_OBJECT_HAS_VERSION)
     self.assertEqual(got, want)
 
-  @mock.patch('urllib.urlopen', side_effect=mock_urllib_urlopen)
+  @mock.patch.object(autoupdate._SESSION, 'get', side_effect=mock_session_get)
   def testAgentReleaseVersionMissing_Successful(self, _):
     got = autoupdate.agent_release_version(TEST_OBJECT_MISSING_VERSION)
     self.assertIsNone(got)
 
-  @mock.patch('urllib.urlopen', side_effect=mock_urllib_urlopen)
+  @mock.patch.object(autoupdate._SESSION, 'get', side_effect=mock_session_get)
   def testAgentReleaseVersionObjectMissing_Successful(self, _):
     got = autoupdate.agent_release_version(TEST_OBJECT_NOT_EXIST)
     self.assertIsNone(got)
 
+  def testAgentReleaseVersionNotModified_Successful(self):
+    responses = [
+        MockResponse(200, '{"metadata": {"AgentVersion": "v1"}}',
+                     headers={'ETag': 'etag-1'}),
+        MockResponse(304, ''),
+    ]
+    with mock.patch.object(autoupdate._SESSION, 'get',
+                           side_effect=responses) as mock_get:
+      self.assertEqual(autoupdate.agent_release_version('url'), 'v1')
+      self.assertEqual(autoupdate.agent_release_version('url'), 'v1')
+
+    mock_get.assert_called_with(
+        'url', headers={'If-None-Match': 'etag-1'}, timeout=30)
+
 
 class CheckProcessTest(unittest.TestCase):
 
@@ -108,11 +172,176 @@ class CheckProcessTest(unittest.TestCase):
     self.assertFalse(autoupdate.is_process_alive(None))
 
 
+class StopAgentTest(unittest.TestCase):
+
+  def testStopAgentTerminates_Successful(self):
+    process = mock.Mock(pid=1)
+    process.poll.return_value = 0
+
+    autoupdate.stop_agent(process)
+
+    process.terminate.assert_called_once_with()
+    process.kill.assert_not_called()
+
+  @mock.patch.object(autoupdate, 'TERMINATE_TIMEOUT_SECONDS', 0)
+  def testStopAgentIgnoresSigterm_Killed(self):
+    process = mock.Mock(pid=1)
+    process.poll.return_value = None
+    process.kill.side_effect = lambda: setattr(process.poll, 'return_value', -9)
+
+    autoupdate.stop_agent(process)
+
+    process.terminate.assert_called_once_with()
+    process.kill.assert_called_once_with()
+
+
+class DownloadAndStartAgentTest(unittest.TestCase):
+
+  def setUp(self):
+    super(DownloadAndStartAgentTest, self).setUp()
+    self.cwd = os.getcwd()
+    self.tmp_dir = tempfile.mkdtemp()
+    os.chdir(self.tmp_dir)
+
+  def tearDown(self):
+    os.chdir(self.cwd)
+    shutil.rmtree(self.tmp_dir)
+    super(DownloadAndStartAgentTest, self).tearDown()
+
+  @mock.patch('subprocess.Popen', return_value=MockPopen(2, None))
+  def testDownloadAndStartAgent_Successful(self, mock_popen):
+    response = MockResponse(200, None, raw=agent_tarball(b'agent binary'))
+    with mock.patch.object(autoupdate._SESSION, 'get',
+                           return_value=response) as mock_get:
+      got = autoupdate.download_and_start_agent(None, 'url', ['--flag'])
+
+    mock_get.assert_called_once_with(
+        'url' + autoupdate.POSTFIX, stream=True, timeout=60)
+    mock_popen.assert_called_once_with(['./agent', '--flag'])
+    self.assertEqual(got.pid, 2)
+    with open('agent', 'rb') as f:
+      self.assertEqual(f.read(), b'agent binary')
+    self.assertFalse(os.path.exists('agent-linux_amd64.tar.gz'))
+
+  @mock.patch('subprocess.Popen', return_value=MockPopen(2, None))
+  def testDownloadAndStartAgentDeadProcess_CacheCleared(self, _):
+    autoupdate._agent_source_cache[1] = (0, 'url')
+    response = MockResponse(200, None, raw=agent_tarball(b'agent binary'))
+    with mock.patch.object(autoupdate._SESSION, 'get', return_value=response):
+      autoupdate.download_and_start_agent(MockPopen(1, 0), 'url', [])
+
+    self.assertNotIn(1, autoupdate._agent_source_cache)
+
+  @mock.patch('subprocess.Popen', return_value=MockPopen(2, None))
+  def testDownloadAndStartAgentDecodedArchive_Successful(self, _):
+    # An object stored with Content-Encoding: gzip reaches tarfile already
+    # decompressed.
+    response = MockResponse(
+        200, None, raw=agent_tarball(b'agent binary', mode='w'))
+    with mock.patch.object(autoupdate._SESSION, 'get', return_value=response):
+      got = autoupdate.download_and_start_agent(None, 'url', [])
+
+    self.assertEqual(got.pid, 2)
+    with open('agent', 'rb') as f:
+      self.assertEqual(f.read(), b'agent binary')
+
+  @mock.patch('subprocess.Popen')
+  def testDownloadAndStartAgentBrokenStream_Failed(self, mock_popen):
+    tarball = agent_tarball(os.urandom(64 * 1024)).getvalue()
+    response = MockResponse(200, None, raw=TruncatedStream(tarball, 1024))
+    with mock.patch.object(autoupdate._SESSION, 'get', return_value=response):
+      got = autoupdate.download_and_start_agent(None, 'url', [])
+
+    self.assertIsNone(got)
+    mock_popen.assert_not_called()
+
+  @mock.patch('subprocess.Popen')
+  def testDownloadAndStartAgentBadArchive_Failed(self, mock_popen):
+    response = MockResponse(200, None, raw=io.BytesIO(b'not a tarball'))
+    with mock.patch.object(autoupdate._SESSION, 'get', return_value=response):
+      got = autoupdate.download_and_start_agent(None, 'url', [])
+
+    self.assertIsNone(got)
+    mock_popen.assert_not_called()
+
+
+class WaitForNextCheckTest(unittest.TestCase):
+
+  def setUp(self):
+    super(WaitForNextCheckTest, self).setUp()
+    self.sigchld_handler = signal.getsignal(signal.SIGCHLD)
+    self.wakeup_fd, self.write_fd = autoupdate.install_child_exit_wakeup()
+
+  def tearDown(self):
+    signal.signal(signal.SIGCHLD, self.sigchld_handler)
+    # Undo install_child_exit_wakeup's siginterrupt(SIGCHLD, False).
+    signal.siginterrupt(signal.SIGCHLD, True)
+    os.close(self.wakeup_fd)
+    os.close(self.write_fd)
+    super(WaitForNextCheckTest, self).tearDown()
+
+  def testWaitForNextCheckTimeout_Successful(self):
+    start = time.time()
+    got = autoupdate.wait_for_next_check(
+        self.wakeup_fd, MockPopen(1, None), 0.1, 0)
+    self.assertGreaterEqual(time.time() - start, 0.1)
+    self.assertFalse(got)
+
+  def testWaitForNextCheckAgentExit_Successful(self):
+    subprocess.Popen(['true']).wait()
+    start = time.time()
+    got = autoupdate.wait_for_next_check(
+        self.wakeup_fd, MockPopen(1, 0), 30, 0)
+    self.assertLess(time.time() - start, 5)
+    self.assertTrue(got)
+
+  def testWaitForNextCheckOtherChildExit_Successful(self):
+    # A child that is not the current agent, e.g. the agent stopped during an
+    # update, must not shorten the wait.
+    subprocess.Popen(['true']).wait()
+    start = time.time()
+    got = autoupdate.wait_for_next_check(
+        self.wakeup_fd, MockPopen(1, None), 0.2, 0)
+    self.assertGreaterEqual(time.time() - start, 0.2)
+    self.assertFalse(got)
+
+
+class NextRestartDelayTest(unittest.TestCase):
+
+  def testNextRestartDelayAgentExited_Successful(self):
+    self.assertEqual(autoupdate.next_restart_delay(10, True, 300), 20)
+    self.assertEqual(autoupdate.next_restart_delay(160, True, 300), 300)
+
+  def testNextRestartDelayAgentStayedUp_Successful(self):
+    self.assertEqual(autoupdate.next_restart_delay(300, False, 300),
+                     autoupdate.MIN_CHECK_INTERVAL_SECONDS)
+
+
+class DeleteAgentSourceFileTest(unittest.TestCase):
+
+  def setUp(self):
+    super(DeleteAgentSourceFileTest, self).setUp()
+    FLAGS(['autoupdate.py'], known_only=True)
+
+  def testDeleteAgentSourceFile_Successful(self):
+    mock_process = MockPopen(1, None)
+    create_agent_update_source_file(mock_process.pid, 'url')
+
+    autoupdate.delete_agent_source_file(mock_process)
+    self.assertFalse(os.path.exists('/tmp/agent_source_1.txt'))
+
+  @mock.patch.object(autoupdate.logging, 'error')
+  def testDeleteAgentSourceFileMissing_Successful(self, mock_error):
+    autoupdate.delete_agent_source_file(MockPopen(1, None))
+    mock_error.assert_not_called()
+
+
 class UpdateURLTest(unittest.TestCase):
 
   def setUp(self):
     super(UpdateURLTest, self).setUp()
     FLAGS(['autoupdate.py'], known_only=True)
+    autoupdate._agent_source_cache.clear()
 
   def testUpdateURL_Successful(self):
     mock_process = MockPopen(1, None)
@@ -124,6 +353,19 @@ class UpdateURLTest(unittest.TestCase):
 
     delete_agent_update_source_file(mock_process.pid)
 
+  def testUpdateURLCached_Successful(self):
+    mock_process = MockPopen(1, None)
+    want = 'https://www.googleapis.com/storage/v1/b/cloud-ingest-canary/o/test'
+    create_agent_update_source_file(mock_process.pid, want)
+    self.assertEqual(autoupdate.update_url(mock_process), want)
+
+    with mock.patch.object(autoupdate, 'open', create=True) as mock_open:
+      got = autoupdate.update_url(mock_process)
+    mock_open.assert_not_called()
+    self.assertEqual(got, want)
+
+    delete_agent_update_source_file(mock_process.pid)
+
   def testReadAgentFileMissingProcess_Successful(self):
     mock_process = MockPopen(1, None)
     want = autoupdate.STABLE_AGENT_BINARY_ADDRESS
@@ -143,7 +385,10 @@ class ValidateUpdateURLTest(unittest.TestCase):
   def testValidateInvalidUpdateURL_Successful(self):
     tc = ['https://www.googleapis.com/storage/v1/b/cloud-ingest-pub/b/test',
           'http://www.googleapis.com/storage/v1/b/cloud-ingest-pub/o/test',
-          '']
+          'https://www.googleapis.com/storage/v1/b/cloud-ingest-pub/o/',
+          'https://www.googleapis.com/storage/v1/b/cloud-ingest-other/o/test',
+          '',
+          None]
     for test in tc:
       self.assertFalse(autoupdate.is_valid_url(test))
 